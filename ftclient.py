@@ -7,49 +7,112 @@
 # requires a command and data port of which ftserver connects back to ftclient
 # to send data specific to the command given.
 #
-# Commands: -l (directory listing), -g [filename] (get filename)
+# Commands: -l (directory listing), -g [filename ...] (get one or more files)
 # Usage: python3 ftclient.py [host] [port] [command] [filename*] [data port]
-# * filename only required for -g (get)
+# * filename only required for -g (get); each extra file uses the next data port
 #
 ###############################################################################
 
 import socket
+import struct
 import sys
-import time
 import os
+import threading
+import collections
+import contextlib
+import concurrent.futures
 
-# Maximum transmission size
-MAX_LIMIT = 1024
+# Receive loop for file transfers when splice(2) can't be used; compiled with
+# mypyc when available
+from ftpump import pump
+
+# Size of the receive buffers used for file transfers
+BUF_SIZE = 256 * 1024
+
+# Free list of receive buffers, shared by every transfer in this process so
+# each recv() fills existing memory instead of allocating new objects. At most
+# POOL_LIMIT idle buffers are kept.
+BUF_POOL = []
+POOL_LIMIT = 8
+
+# Command line arguments, parsed once at startup by parseArgs()
+Args = collections.namedtuple("Args", ["host", "port", "cmd", "filenames", "dataPort"])
+
+# Connection backlog for data port listening sockets
+LISTEN_BACKLOG = 128
+
+# splice(2) is available (Linux, Python 3.10+): file data can be moved from the
+# data socket to disk without passing through Python
+HAS_SPLICE = hasattr(os, "splice")
+
+# TCP_QUICKACK is available (Linux): delayed ACKs can be turned off on the
+# data connection. The kernel drops back to delayed ACKs on its own, so the
+# option is set again after each of the first QUICKACK_RECVS receives.
+HAS_QUICKACK = hasattr(socket, "TCP_QUICKACK")
+QUICKACK_RECVS = 16
+
+# Serializes overwrite prompts when several files are fetched at once
+PROMPT_LOCK = threading.Lock()
+
+# Optional socket buffer size (bytes) for the data socket, read from the
+# FTCLIENT_WINDOW environment variable. Left unset, or set to something that
+# is not a number of bytes, the kernel autotunes.
+try:
+    WINDOW_SIZE = int(os.environ.get("FTCLIENT_WINDOW", "0"))
+except ValueError:
+    print("Ignoring FTCLIENT_WINDOW: expected a number of bytes, e.g. 4194304")
+    WINDOW_SIZE = 0
+
+# If FTCLIENT_OVERLAP is set, file data is written to disk on a background
+# thread while the next chunk is received from the network.
+OVERLAP = os.environ.get("FTCLIENT_OVERLAP", "0") != "0"
 
 ###############################################################################
-# getMsg()
-# Description: Receives text from a file descriptor and decodes it from bytes 
-# to plaintext.
+# recvExact()
+# Description: Receives exactly n bytes from a connection, calling recv_into()
+# as many times as needed.
 #
 # Pre-conditions: A valid connection exists from which data will be sent.
-# Post-conditions: Places text from the connection into a variable named data.
+# Post-conditions: Returns a bytearray of n bytes, or raises ConnectionError if
+# the connection closes first.
 ###############################################################################
 
-def getMsg(connection):
-    data = connection.recv(MAX_LIMIT)
-    data = data.decode("utf-8")
-    data = data.strip('\n')
-    return data
+def recvExact(connection, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    received = 0
+    while received < n:
+        count = connection.recv_into(view[received:])
+        if not count:
+            raise ConnectionError("ftserver closed the connection")
+        received += count
+    return buf
 
 ###############################################################################
-# syntaxCheck()
-# Description: Given an array of command line arguments, ensures proper length
-# of arguments and syntax usage. Calls badSyntaxExit() if errors are found.
+# sendMsg()
+# Description: Sends a control message preceded by its length as a 4-byte
+# big-endian integer.
 #
-# Pre-conditions: None
-# Post-conditions: Calls badSyntaxExit() on bad length or syntax usage.
+# Pre-conditions: A valid connection and an encoded message are provided.
+# Post-conditions: The length header and message are fully sent.
 ###############################################################################
 
-def syntaxCheck(args):
-    if (len(args) < 5 or len(args) > 6):
-        badSyntaxExit()
-    if (args[3] == "-g" and len(args) < 6):
-        badSyntaxExit()
+def sendMsg(connection, payload):
+    connection.sendall(struct.pack(">I", len(payload)) + payload)
+
+###############################################################################
+# getMsg()
+# Description: Receives a length-prefixed control message. The message is
+# left as bytes since control tokens are plain ASCII; callers decode it only
+# when it needs to be printed.
+#
+# Pre-conditions: A valid connection exists from which data will be sent.
+# Post-conditions: Returns the message bytes without the trailing newline.
+###############################################################################
+
+def getMsg(connection):
+    (length,) = struct.unpack(">I", recvExact(connection, 4))
+    return recvExact(connection, length).rstrip(b'\n')
 
 ###############################################################################
 # badSyntaxExit()
@@ -60,75 +123,238 @@ def syntaxCheck(args):
 ###############################################################################
 
 def badSyntaxExit():
-    print("USAGE: python3 ftclient.py [server host] [server port] [command] [filename] [data port]")
-    print("Available commands: List: -l or Get: -g [filename]")
+    print("USAGE: python3 ftclient.py [server host] [server port] [command] [filename ...] [data port]")
+    print("Available commands: List: -l or Get: -g [filename ...]")
     sys.exit(1)
     
 
+###############################################################################
+# parseArgs()
+# Description: Given an array of command line arguments, checks their count
+# and syntax in a single pass and extracts the server host, control port,
+# command, filenames and data port. The data port is always the last argument.
+# Calls badSyntaxExit() if errors are found.
+#
+# Pre-conditions: None
+# Post-conditions: Returns the parsed arguments as an Args tuple, or calls
+# badSyntaxExit() on bad length, syntax usage or port numbers.
+###############################################################################
+
+def parseArgs(argv):
+    if (len(argv) < 5):
+        badSyntaxExit()
+    cmd = argv[3]
+    filenames = tuple(argv[4:-1])
+    if (cmd == "-g" and not filenames):
+        badSyntaxExit()
+    if (cmd != "-g" and len(filenames) > 1):
+        badSyntaxExit()
+    try:
+        port = int(argv[2])
+        dataPort = int(argv[-1])
+    except ValueError:
+        badSyntaxExit()
+    # Every file fetched needs its own data port
+    lastDataPort = dataPort + max(len(filenames), 1) - 1
+    if not (0 < port < 65536 and 0 < dataPort and lastDataPort < 65536):
+        badSyntaxExit()
+    return Args(argv[1], port, cmd, filenames, dataPort)
+
 ###############################################################################
 # initiateContact()
 # Description: Creates a TCP socket and attempts to connect another host.
 #
-# Pre-conditions: Proper host and ports are provided via command line.
+# Pre-conditions: A host and control port are provided.
 # Post-conditions: Creates socket, connects to the host and returns the socket.
+# If the connection fails, the socket is closed and the error is raised.
 ###############################################################################
 
-def initiateContact():
-    host = sys.argv[1]
-    port = sys.argv[2]
+def initiateContact(host, port):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((host, int(port)))
+    try:
+        s.connect((host, port))
+    except OSError:
+        # The caller never receives this socket, so close it here
+        s.close()
+        raise
+    # Control messages are small request/reply exchanges; send them
+    # immediately rather than letting Nagle's algorithm hold them back.
+    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     return s
 
 ###############################################################################
 # makeRequest()
-# Description: Creates a string that is sent to ftserver, providing information
-# regarding the dat aport, command, and filename.
-#
-# Pre-conditions: Proper data port is provided via command line arguments.
-# Post-conditions: Creates a string and returns it.
-###############################################################################
-
-def makeRequest(dataPort):
-    # Embed data port in string
-    startString = ("PORTSTART:" + str(dataPort))
-    startString += "PORTEND"
-    startString += "CMD:"
-    if sys.argv[3] == "-l":
-        # List
-        startString += "LIST"
-        # Get
-    elif sys.argv[3] == "-g":
-        startString += "GET"
-        startString += "FILENAME:"
-        startString += sys.argv[4]
-        startString += "FILENAMEEND"
-        # Other 
-    else: startString += "UNKNOWN"
-
-    # The server expects to receive a 100-byte string, so it is padded.
-    while len(startString) < 99:
-        startString += "#"
-    startString += '\0'
-    return startString
-
-###############################################################################
-# getDataPort()
-# Description: Depending on the command provided, the data port changes position
-# within the array of command line arguments. This function extracts it, depending
-# on the length of the argument array.
-#
-# Pre-conditions: Proper data port is provided via command line arguments.
-# Post-conditions: Extracts the string used for the data port and returns it
-# as a number.
-###############################################################################
-
-def getDataPort():
-    if ((len(sys.argv)) == 5):
-        dataPort = sys.argv[4]
+# Description: Creates the request that is sent to ftserver, providing
+# information regarding the data port, command, and filename.
+#
+# Pre-conditions: A data port, command, and filename (for -g) are provided.
+# Post-conditions: Returns the request encoded as bytes.
+###############################################################################
+
+def makeRequest(dataPort, cmd, filename):
+    # Embed data port and command in the request
+    if cmd == "-l":
+        body = f"PORTSTART:{dataPort}PORTENDCMD:LIST"
+    elif cmd == "-g":
+        body = f"PORTSTART:{dataPort}PORTENDCMD:GETFILENAME:{filename}FILENAMEEND"
     else:
-        dataPort = sys.argv[5]
-    return int(dataPort)
+        body = f"PORTSTART:{dataPort}PORTENDCMD:UNKNOWN"
+    return body.encode("utf-8")
+
+###############################################################################
+# getBuf()
+# Description: Takes a receive buffer from the pool, allocating a new one if
+# the pool is empty.
+#
+# Pre-conditions: None
+# Post-conditions: Returns a bytearray of BUF_SIZE bytes that the caller must
+# hand back with putBuf().
+###############################################################################
+
+def getBuf():
+    try:
+        return BUF_POOL.pop()
+    except IndexError:
+        return bytearray(BUF_SIZE)
+
+###############################################################################
+# putBuf()
+# Description: Returns a receive buffer to the pool for later reuse.
+#
+# Pre-conditions: buf came from getBuf() and is no longer in use.
+# Post-conditions: buf is kept for reuse unless the pool is already full.
+###############################################################################
+
+def putBuf(buf):
+    if len(BUF_POOL) < POOL_LIMIT:
+        BUF_POOL.append(buf)
+
+###############################################################################
+# quickAck()
+# Description: Asks the kernel to acknowledge incoming data on a connection
+# immediately instead of delaying ACKs, which speeds up TCP slow start for
+# short transfers.
+#
+# Pre-conditions: A valid connection is provided.
+# Post-conditions: Quick-ack mode is enabled where supported; otherwise
+# nothing happens.
+###############################################################################
+
+def quickAck(connection):
+    if HAS_QUICKACK:
+        try:
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        except OSError:
+            pass
+
+###############################################################################
+# receiveOverlapped()
+# Description: Copies everything received on a data connection into a file,
+# alternating between two buffers so that one is being written to disk by a
+# writer thread while the other is filled from the network.
+#
+# Pre-conditions: A valid data connection and a file opened for writing.
+# Post-conditions: All data sent by the server has been written to the file.
+###############################################################################
+
+def receiveOverlapped(dataFD, f):
+    buf = getBuf()
+    spare = getBuf()
+    try:
+        views = [memoryview(buf), memoryview(spare)]
+        pending = [None, None]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+            i = 0
+            count = 0
+            while True:
+                # Wait for the previous write from this buffer before reusing it
+                if pending[i] is not None:
+                    pending[i].result()
+                n = dataFD.recv_into(views[i])
+                if not n:
+                    break
+                pending[i] = writer.submit(f.write, views[i][:n])
+                i ^= 1
+                if count < QUICKACK_RECVS:
+                    quickAck(dataFD)
+                    count += 1
+            # Surface any error from the last outstanding write
+            for future in pending:
+                if future is not None:
+                    future.result()
+    finally:
+        putBuf(buf)
+        putBuf(spare)
+
+###############################################################################
+# receiveCopied()
+# Description: Copies everything received on a data connection into a file
+# through a pooled receive buffer, using the receive loop from ftpump.
+#
+# Pre-conditions: A valid data connection and a file opened for writing.
+# Post-conditions: All data sent by the server has been written to the file.
+###############################################################################
+
+def receiveCopied(dataFD, f):
+    buf = getBuf()
+    try:
+        pump(dataFD, f, buf, quickAck, QUICKACK_RECVS)
+    finally:
+        putBuf(buf)
+
+###############################################################################
+# receiveSpliced()
+# Description: Moves everything received on a data connection into a file
+# with splice(2), going socket -> pipe -> file inside the kernel so the data
+# is never copied into Python.
+#
+# Pre-conditions: HAS_SPLICE is true; a valid data connection and a file
+# opened for writing are provided.
+# Post-conditions: Returns True once all data has been written to the file, or
+# False if splice() is not supported for this socket or file. In that case any
+# data already taken from the socket has been written to f, and the caller
+# copies the rest with receiveCopied().
+###############################################################################
+
+def receiveSpliced(dataFD, f):
+    # Raw writes go to the file descriptor, so empty f's buffer first
+    f.flush()
+    readFD, writeFD = os.pipe()
+    try:
+        sockFD = dataFD.fileno()
+        fileFD = f.fileno()
+        count = 0
+        fileSpliced = False
+        while True:
+            try:
+                n = os.splice(sockFD, writeFD, BUF_SIZE)
+            except OSError:
+                if count == 0:
+                    return False
+                raise
+            if not n:
+                return True
+            if count < QUICKACK_RECVS:
+                quickAck(dataFD)
+            count += 1
+            # Drain the pipe into the file
+            while n:
+                try:
+                    n -= os.splice(readFD, fileFD, n)
+                except OSError:
+                    if fileSpliced:
+                        raise
+                    # The file can't be spliced into; write out what the
+                    # pipe already holds so nothing is lost
+                    while n:
+                        chunk = os.read(readFD, n)
+                        f.write(chunk)
+                        n -= len(chunk)
+                    return False
+                fileSpliced = True
+    finally:
+        os.close(readFD)
+        os.close(writeFD)
 
 ###############################################################################
 # receiveData()
@@ -136,110 +362,153 @@ def getDataPort():
 # program. Gets a directory listing or facilitates file transfer, prompting
 # for overwriting a file if a duplicate file exists.
 #
-# Pre-conditions: A valid file descriptor is provided.
+# Pre-conditions: Valid control and data connections, the command and the
+# filename (for -g) are provided.
 # Post-conditions: Prints a directory listing or facilitates file transfer.
 ###############################################################################
 
-def receiveData(controlFD, dataFD):
+def receiveData(controlFD, dataFD, cmd, filename):
     # Expecting a directory listing
-    if sys.argv[3] == "-l":
-        dirListing = getMsg(dataFD)
+    if cmd == "-l":
+        # Read until the server closes the data connection
+        with dataFD.makefile('rb', buffering=1 << 20) as stream:
+            dirListing = stream.read().decode("utf-8", "replace").strip('\n')
         print("Directory contents:")
         print(dirListing)
         return
     
     # Expecting a file; handle duplicate files
-    if sys.argv[3] == "-g":
+    if cmd == "-g":
         status = getMsg(controlFD)
-        if "ERROR" in status:
-            print("Message from server: " + status)
-            controlFD.close()
-            dataFD.close()
+        if b"ERROR" in status:
+            print("Message from server: " + status.decode("utf-8", "replace"))
             return
         
-        if os.path.isfile(sys.argv[4]):
-            overwrite = input(sys.argv[4] + " already exists. Overwrite? N = no, anything else = yes\n")
+        # Create the file only if it is new; opening and checking in one call
+        # leaves no window for the file to appear in between
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            with PROMPT_LOCK:
+                overwrite = input(filename + " already exists. Overwrite? N = no, anything else = yes\n")
             if overwrite.lower() == 'n':
                 print("Transfer aborted.")
                 return
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
         
-        with open(sys.argv[4], 'wb') as f:
-            print("Transferring " + sys.argv[4] + ".")
-            while True:
-                data = dataFD.recv(1024)
-                if not data:
-                    break
-                f.write(data)
+        # A large write buffer batches chunks into fewer write() calls
+        with os.fdopen(fd, 'wb', buffering=1 << 20) as f:
+            print("Transferring " + filename + ".")
+            if OVERLAP:
+                receiveOverlapped(dataFD, f)
+            elif not (HAS_SPLICE and receiveSpliced(dataFD, f)):
+                receiveCopied(dataFD, f)
         print("Transfer complete.")        
-        f.close()
         return
 
 ###############################################################################
 # socketStart()
-# Description: Creates a TCP socket and binds it .
+# Description: Creates a TCP socket and binds it. If FTCLIENT_WINDOW is set,
+# the send and receive buffers are enlarged to that many bytes.
 #
 # Pre-conditions: Valid host and port strings are provided.
 # Post-conditions: Returns a socket bound to the host and port.
+# If setup or binding fails, the socket is closed and the error is raised.
 ###############################################################################
 
 def socketStart(HOST, PORT):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)		
-    # Reuse socket if it is still in use by the OS
-    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    s.bind((HOST, int(PORT)))
+    try:
+        # Reuse socket if it is still in use by the OS
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Enlarge the socket buffers before listen() so accepted connections
+        # inherit them; only done on request since it disables autotuning.
+        if WINDOW_SIZE > 0:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, WINDOW_SIZE)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, WINDOW_SIZE)
+        s.bind((HOST, int(PORT)))
+    except OSError:
+        # The caller never receives this socket, so close it here
+        s.close()
+        raise
     return s
     
+###############################################################################
+# transfer()
+# Description: Carries out one request: listens on the data port, sends the
+# request to ftserver on the control port, then receives the directory listing
+# or file once the server connects back.
+#
+# Pre-conditions: Parsed arguments, the filename to fetch (for -g) and a free
+# data port are provided.
+# Post-conditions: The request is fulfilled or the server's error is printed,
+# and all sockets used for it are closed once.
+###############################################################################
+
+def transfer(args, filename, dataPort):
+    cmd = args.cmd
+    # Create a string to send to server detailing data port and command
+    request = makeRequest(dataPort, cmd, filename)
+
+    # Every socket opened below is closed exactly once when this block exits,
+    # including on early returns and errors
+    with contextlib.ExitStack() as stack:
+        # Listen on data port
+        s2 = stack.enter_context(socketStart('', dataPort))
+        s2.listen(LISTEN_BACKLOG)
+        print("Listening on data port " + str(dataPort))
+
+        # Connect to the server on a control port and send the info string
+        # No delay is needed: the data port is already listening, and the reply
+        # read below waits for the server.
+        s = stack.enter_context(initiateContact(args.host, args.port))
+        sendMsg(s, request)
+
+        # Check if the server has acknowledged a valid command or an error message
+        confirm = getMsg(s)
+        if b"ERROR:" in confirm:
+            print(confirm.decode("utf-8", "replace"))
+            return
+        else: print("Connected to ftserver on control port " + str(args.port))
+
+        # Accept connections on the data port
+        dpConnection, client_address = s2.accept()
+        stack.enter_context(dpConnection)
+        quickAck(dpConnection)
+        print("ftserver connected on data port " + str(dataPort))
+        if WINDOW_SIZE > 0:
+            rcvbuf = dpConnection.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            print("Data socket receive buffer: " + str(rcvbuf) + " bytes")
+
+        # Get data from the server on data port connection
+        receiveData(s, dpConnection, cmd, filename)
+
 ###############################################################################
 # Main Program
 #
-# Basic program flow: Syntax check, listen on data port, connect to server on 
+# Basic program flow: Parse arguments, listen on data port, connect to server on 
 # control port, send the request in the form of a string, server connects on
 # data port, client receives data or an error message back. Handles duplicate
 # files by asking to overwrite. Handles unknown commands and non-existent file
-# names.
-###############################################################################
-
-# Check syntax
-syntaxCheck(sys.argv)
-
-# Extract server host, control port, data port
-host = sys.argv[1]
-port = sys.argv[2]
-dataPort = getDataPort()
-
-# Create a string to send to server detailing data port and command
-startString = makeRequest(dataPort)
-
-# Listen on data port
-s2 = socketStart('', dataPort)
-s2.listen()
-print("Listening on data port " + str(dataPort))
-
-# Connect to the server on a control port and send the info string
-s = initiateContact()
-time.sleep(1)
-s.send(bytes(startString, "utf8"))
-
-# Check if the server has acknowledged a valid command or an error message
-confirm = getMsg(s)
-if "ERROR:" in confirm:
-    print(confirm)
-    s.close()
-    s2.close()
-    sys.exit(0)
-else: print("Connected to ftserver on control port " + port)
-
-# Accept connections on the data port
-dpConnection, client_address = s2.accept()
-print("ftserver connected on data port " + str(dataPort))
-time.sleep(1)
-
-# Get data from the server on data port connection
-receiveData(s, dpConnection)
-
-# Close sockets and connections and end program
-s.close()
-s2.close()
-dpConnection.close()
+# names. Several files given to -g are fetched concurrently, each with its
+# own control connection and data port (data port, data port + 1, ...).
+###############################################################################
+
+# Check syntax and extract server host, control port, command, filenames and
+# data port once
+ARGS = parseArgs(sys.argv)
+
+if ARGS.cmd == "-g" and len(ARGS.filenames) > 1:
+    # Fetch each file over its own connections, using consecutive data ports
+    workers = min(32, len(ARGS.filenames))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(transfer, ARGS, name, ARGS.dataPort + i)
+                   for i, name in enumerate(ARGS.filenames)]
+        for future in futures:
+            future.result()
+else:
+    filename = ARGS.filenames[0] if ARGS.filenames else None
+    transfer(ARGS, filename, ARGS.dataPort)
+
 print("** Operations complete. Closing connections. **")
-sys.exit(0)
\ No newline at end of file
+sys.exit(0)
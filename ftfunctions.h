@@ -20,6 +20,8 @@
 #include <netdb.h>
 #include <arpa/inet.h>
 
+#define MAX_REQUEST 1024 // Largest request accepted from a client
+
 void error(const char *msg) { perror(msg); exit(1); } // Error function used for reporting issues
 
 /********************************************************************* 
@@ -99,9 +101,8 @@ void sendMsg(char* buffer, int socketFD)
 ** recMsg()
 * Description: Given a buffer, a valid socket file descriptor, and
 * a message size, receives a specific amount of data and places it in
-* the buffer. In essence, uses recv() with some error checks and
-* checks to ensure that the correct amount of data is received and placed
-* in the buffer.
+* the buffer. In essence, uses recv() with some error checks, calling
+* it repeatedly until the requested number of bytes has arrived.
 * 
 * Pre-conditions: An adequately-sized buffer for incoming messages,
 * valid socket file descriptor and number of bytes to receive are defined
@@ -116,28 +117,67 @@ void recMsg(char* buffer, int bytesToReceive, int socketFD)
     
     // bytes rec'd from current iteration of recv
     int charsRec = 0;
+    // total count of bytes received so far
+    int totalCharsRec = 0;
     // max data to receive at a time
     int maxRecBytes = 1000;
     // Note: from prior experience, about 1000 characters can be received
     // without error.
-    if (bytesToReceive < maxRecBytes)
-    {
-        maxRecBytes = bytesToReceive;
-    }
     
-    // Place data received through socketFD into the buffer
-    charsRec = recv(socketFD, buffer, maxRecBytes, 0);
-    
-    // Error checking
-    if (charsRec < 0)
+    while (totalCharsRec < bytesToReceive)
     {
-        error("ERROR receiving from socket");
+        // Don't read past the end of this message
+        if (bytesToReceive - totalCharsRec < maxRecBytes)
+        {
+            maxRecBytes = bytesToReceive - totalCharsRec;
+        }
+        
+        // Place data received through socketFD into the buffer
+        charsRec = recv(socketFD, buffer + totalCharsRec, maxRecBytes, 0);
+        
+        // Error checking
+        if (charsRec < 0)
+        {
+            error("ERROR receiving from socket");
+        }
+        else if (charsRec == 0)
+        {
+            error("ERROR: nothing received");
+        }
+        totalCharsRec += charsRec;
     }
-    else if (charsRec == 0)
+
+}
+
+/********************************************************************* 
+** sendFrame()
+* Description: Sends a control message preceded by its length as a
+* 4-byte big-endian integer, so the receiver knows exactly how many
+* bytes belong to the message.
+* 
+* Pre-conditions: A null-terminated message and a socket file descriptor
+* are passed to sendFrame().
+* Post-conditions: The length header and message are sent through
+* socketFD, or an error message is printed.
+*********************************************************************/
+
+void sendFrame(char* buffer, int socketFD)
+{
+    uint32_t header = htonl(strlen(buffer));
+    char* ptr = (char*)&header;
+    int remainingBytes = sizeof(header);
+    // Send the length header, resuming after partial sends
+    while (remainingBytes > 0)
     {
-        error("ERROR: nothing received");
+        int charsSent = send(socketFD, ptr, remainingBytes, 0);
+        if (charsSent < 0)
+        {
+            error("ERROR writing to socket");
+        }
+        ptr += charsSent;
+        remainingBytes -= charsSent;
     }
-
+    sendMsg(buffer, socketFD);
 }
 
 /********************************************************************* 
@@ -241,7 +281,8 @@ int createSocketFD(int socket)
 /********************************************************************* 
 ** getRequest()
 * Description: Given a connection file descriptor, accepts a string
-* that the server can parse for information.
+* that the server can parse for information. The request is preceded
+* by its length as a 4-byte big-endian integer.
 * 
 * Pre-conditions: A connection is established.
 * Post-conditions: A dynamically allocated string is returned with
@@ -250,10 +291,21 @@ int createSocketFD(int socket)
 
 char* getRequest(int establishedConnectionFD)
 {
-    int bufferSize = sizeof(char) * 101;
-    char* buffer = malloc(bufferSize);
-    memset(buffer, '\0', bufferSize);
-    recv(establishedConnectionFD, buffer, 100, 0);
+    uint32_t header;
+    recMsg((char*)&header, sizeof(header), establishedConnectionFD);
+    // Unsigned, so a huge header can't wrap negative and pass the check
+    uint32_t length = ntohl(header);
+    if (length > MAX_REQUEST)
+    {
+        error("ERROR: request too long");
+    }
+    char* buffer = malloc(length + 1);
+    if (buffer == NULL)
+    {
+        error("ERROR allocating request buffer");
+    }
+    memset(buffer, '\0', length + 1);
+    recMsg(buffer, length, establishedConnectionFD);
     return buffer;
 }
 
@@ -303,19 +355,30 @@ void processRequest(char* buffer, int controlFD, int dataFD)
         // Find the file name requested by the client in the request string
         // Two pointers, one at the start of the filename, one at the end
         char* filenamePtr = (strstr(buffer, "FILENAME:"));
-        filenamePtr += strlen("FILENAME:");
         char* filenameEndPtr = (strstr(buffer, "FILENAMEEND"));
+        // Reject requests missing either marker or with them out of order
+        if (filenamePtr == NULL || filenameEndPtr == NULL
+            || filenameEndPtr < filenamePtr + strlen("FILENAME:"))
+        {
+            printf("ERROR: Malformed request.\n");
+            sendFrame("ERROR: Malformed request.", controlFD);
+            return;
+        }
+        filenamePtr += strlen("FILENAME:");
         
         char filename[255];
         memset(filename, '\0', sizeof(filename));
-        int i = 0;
-        // Copy the filename from the request
-        while (filenamePtr != filenameEndPtr)
+        // Copy the filename from the request in one call, leaving room
+        // for the terminating null. A name that doesn't fit is refused
+        // rather than shortened, which could match a different file.
+        size_t filenameLength = filenameEndPtr - filenamePtr;
+        if (filenameLength >= sizeof(filename))
         {
-            filename[i] = *filenamePtr;
-            filenamePtr++;
-            i++;
+            printf("ERROR: Filename too long.\n");
+            sendFrame("ERROR: Filename too long.", controlFD);
+            return;
         }
+        memcpy(filename, filenamePtr, filenameLength);
         
         printf("Client requested file: %s\n", filename);
         // Open the file
@@ -323,7 +386,7 @@ void processRequest(char* buffer, int controlFD, int dataFD)
         // Client will be waiting for confirmation or error on control FD
         if (fp)
         {
-            sendMsg("SENDING", controlFD);
+            sendFrame("SENDING", controlFD);
             // go to the end of the file and count how many bytes from the beginning
             fseek(fp, 0, SEEK_END);
             int length = ftell(fp);
@@ -342,10 +405,11 @@ void processRequest(char* buffer, int controlFD, int dataFD)
         // File not found; send back error
         else 
         {
-            char errorString[255];
-            sprintf(errorString, "ERROR: %s not found.", filename);
+            // Room for the message text around the longest filename
+            char errorString[sizeof(filename) + 32];
+            snprintf(errorString, sizeof(errorString), "ERROR: %s not found.", filename);
             printf("%s\n", errorString);
-            sendMsg(errorString, controlFD);
+            sendFrame(errorString, controlFD);
         }
     }
 }
@@ -363,19 +427,24 @@ char* getDataPortStr(char* buffer)
 {
     // Extract the port from within the request string
     char* portStart = strstr(buffer, "PORTSTART:");
-    portStart += 10;
     char* portEnd = strstr(buffer, "PORTEND");
     char* portStr = malloc(sizeof(char) * 10);
     memset(portStr, '\0', sizeof(char) * 10);
+    // A malformed request yields an empty port string
+    if (portStart == NULL || portEnd == NULL || portEnd < portStart + 10)
+    {
+        return portStr;
+    }
+    portStart += 10;
     
-    // Using the two pointers, iterate until we have the entire port number
-    int i = 0;
-    while (portStart != portEnd)
+    // Using the two pointers, copy the entire port number at once. A port
+    // field too long for portStr yields an empty port string.
+    size_t portLength = portEnd - portStart;
+    if (portLength > 9)
     {
-        portStr[i] = *portStart;
-        i++;
-        portStart++;
+        return portStr;
     }
+    memcpy(portStr, portStart, portLength);
     
     return portStr;
 }
@@ -50,14 +50,14 @@ int main(int argc, char *argv[])
             {
                 printf("Invalid command issued from client. Terminating connection.");
                 char errorString[] = "ERROR: Invalid command. Try -l (list) or -g <FILENAME> (get)\n";
-                sendMsg(errorString, controlFD);
+                sendFrame(errorString, controlFD);
             }
             // Valid command
             else
             {
                 // Acknowledge valid command (client will be waiting for an okay or error message)
                 char validCmd[] = "CONTINUE";
-                sendMsg(validCmd, controlFD);
+                sendFrame(validCmd, controlFD);
                 // Extract client's host information to connect on the data port
                 char ipstr[INET6_ADDRSTRLEN];
                 getClientHostInfo(controlFD, ipstr);